@@ -3,9 +3,10 @@ import datetime
 import logging
 import os
 import sys
-from itertools import groupby
-from typing import Optional, Sequence
+import time
+from typing import Awaitable, Dict, FrozenSet, List, Optional, Sequence, Tuple
 
+import aiohttp
 import discord
 from discord.ext import commands, tasks
 
@@ -13,7 +14,24 @@ from .MessageRegistry import MessageRegistry
 
 
 class AutoDeleteBot(commands.Bot):
-    def __init__(self, sync_commands: bool, db_path: str, log_path: str, *, protect_pins: bool = False):
+    # Seconds for which a channel's pinned messages are reused before being fetched again.
+    PINS_CACHE_TTL = 30
+    # Seconds for which channels fetched from the API are reused before being fetched again.
+    CHANNEL_CACHE_TTL = 60
+    # Deletion times less than this much earlier than the current wake time don't interrupt the monitor's sleep.
+    WAKE_TIME_TOLERANCE = datetime.timedelta(seconds=1)
+    # Number of historical messages registered per database commit while scanning a channel.
+    SCAN_BATCH_SIZE = 500
+
+    def __init__(
+        self,
+        sync_commands: bool,
+        db_path: str,
+        log_path: str,
+        *,
+        protect_pins: bool = False,
+        connector: Optional[aiohttp.BaseConnector] = None,
+    ):
         self.sync = sync_commands
         self.db_path = db_path
         self.log_path = log_path
@@ -21,8 +39,10 @@ class AutoDeleteBot(commands.Bot):
         self.work_pending = asyncio.Event()
         self.delete_lock = asyncio.Lock()
         self.wake_time = discord.utils.utcnow()
-        self.active_sleep = None
+        self.wake_time_changed = asyncio.Event()
         self.protect_pins = protect_pins
+        self._pins_cache: Dict[int, Tuple[float, FrozenSet[int]]] = {}
+        self._channel_cache: Dict[int, Tuple[float, discord.abc.Messageable]] = {}
 
         intents = discord.Intents.none()
         intents.guilds = True
@@ -32,6 +52,7 @@ class AutoDeleteBot(commands.Bot):
             command_prefix=commands.when_mentioned,
             intents=intents,
             application_id=application_id,
+            connector=connector,
         )
 
     def _setup_logger(self) -> None:
@@ -66,6 +87,7 @@ class AutoDeleteBot(commands.Bot):
     async def __aenter__(self):
         self.message_registry = await MessageRegistry.open(client=self, db_path=self.db_path)
         self.add_listener(self._register_message_for_deletion, "on_message")
+        self.add_listener(self._invalidate_pins, "on_guild_channel_pins_update")
         return await super().__aenter__()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
@@ -73,48 +95,87 @@ class AutoDeleteBot(commands.Bot):
         return await super().__aexit__(exc_type, exc_val, exc_tb)
 
     async def _register_message_for_deletion(self, message: discord.Message) -> Optional[datetime.datetime]:
-        delete_at = await self.message_registry.register_message(message)
+        delete_at = self.message_registry.register_message(message)
+        if delete_at is not None:
+            self.work_pending.set()
+            await self._shorten_sleep(delete_at)
+        return delete_at
+
+    async def _register_messages_for_deletion(self, messages: Sequence[discord.Message]) -> Optional[datetime.datetime]:
+        delete_at = await self.message_registry.register_messages_bulk(messages)
         if delete_at is not None:
             self.work_pending.set()
             await self._shorten_sleep(delete_at)
         return delete_at
 
     async def scan_channel(self, channel: discord.TextChannel, from_beginning: bool = False) -> None:
-        self.logger.debug(f"Scanning channel {channel.id}.")
+        self.logger.debug("Scanning channel %s.", channel.id)
         channel_config = self.message_registry.channels.get(channel.id)
         if channel_config is None:
             raise ValueError("Cannot scan unregistered channel.")
 
         after = channel_config.after
         if not from_beginning:
-            latest_message = await self.message_registry.get_latest_message(channel.id)
-            if latest_message is not None and latest_message.created_at > after.created_at:
+            latest_message = await self.message_registry.get_latest_message(channel.id, after=after.id)
+            if latest_message is not None:
                 after = latest_message
 
+        # The gateway keeps track of each channel's latest message, so channels without anything new can be skipped
+        # without paginating through their history.
+        if channel.last_message_id is not None and channel.last_message_id <= after.id:
+            self.logger.debug("Finished scanning channel %s, no new messages.", channel.id)
+            return
+
         found_count = 0
+        pending_messages: List[discord.Message] = []
         async for message in channel.history(limit=None, after=after, oldest_first=True):
-            found_count += await self._register_message_for_deletion(message) is not None
-        self.logger.debug(f"Finished scanning channel {channel.id}, found {found_count} messages.")
+            pending_messages.append(message)
+            if len(pending_messages) >= self.SCAN_BATCH_SIZE:
+                if await self._register_messages_for_deletion(pending_messages) is not None:
+                    found_count += len(pending_messages)
+                pending_messages = []
+        if pending_messages and await self._register_messages_for_deletion(pending_messages) is not None:
+            found_count += len(pending_messages)
+        self.logger.debug("Finished scanning channel %s, found %s messages.", channel.id, found_count)
 
-    async def fetch_or_deregister_channel(self, channel_id: int):
+    async def resolve_channel(self, channel_id: int, *, fresh: bool = False, defer_deregistration: bool = False):
+        """
+        Returns the channel with the given ID from the client's cache, or otherwise from the API.
+        Channels fetched from the API are reused for CHANNEL_CACHE_TTL seconds, unless `fresh` is set.
+        Since the gateway doesn't update these copies, callers relying on their state (e.g. last_message_id)
+        should set `fresh`.
+        Channels that no longer exist are deregistered, and discord.NotFound is raised.
+        `defer_deregistration` is passed on to MessageRegistry.deregister_channel.
+        """
         channel = self.get_channel(channel_id)
         if channel is not None:
             return channel
-        else:
-            try:
-                return await self.fetch_channel(channel_id)
-            except discord.NotFound:
-                await self.message_registry.deregister_channel(channel_id)
-                raise
+        cached = self._channel_cache.get(channel_id)
+        if not fresh and cached is not None and time.monotonic() - cached[0] < self.CHANNEL_CACHE_TTL:
+            return cached[1]
+        try:
+            channel = await self.fetch_channel(channel_id)
+        except discord.NotFound:
+            await self.message_registry.deregister_channel(channel_id, defer=defer_deregistration)
+            raise
+        self._channel_cache[channel_id] = (time.monotonic(), channel)
+        return channel
 
     async def scan_all_channels(self, from_beginning: bool = False) -> None:
         await self.wait_until_ready()
+        # Channels missing from the cache are fetched concurrently rather than one at a time.
+        # Scans rely on last_message_id, so previously fetched copies can't be reused.
+        results = await asyncio.gather(
+            *(self.resolve_channel(channel_id, fresh=True) for channel_id in self.message_registry.channels),
+            return_exceptions=True,
+        )
         channels = []
-        for channel_id in self.message_registry.channels:
-            try:
-                channels.append(self.get_channel(channel_id) or await self.fetch_or_deregister_channel(channel_id))
-            except discord.NotFound:
+        for result in results:
+            if isinstance(result, discord.NotFound):
                 continue
+            elif isinstance(result, BaseException):
+                raise result
+            channels.append(result)
         await asyncio.gather(*(self.scan_channel(channel, from_beginning) for channel in channels))
 
     async def _begin_monitor(self):
@@ -125,13 +186,50 @@ class AutoDeleteBot(commands.Bot):
         # to the extent that it cannot replay missed events, so it may have missed some messages
         self.add_listener(self.scan_all_channels, name="on_ready")
 
-    async def is_protected_message(self, message: discord.PartialMessage):
-        # Protects pinned messages from deletion
+    async def _get_pins(self, channel: discord.abc.Messageable) -> FrozenSet[int]:
+        """Returns the IDs of a channel's pinned messages, reusing recent results."""
+        cached = self._pins_cache.get(channel.id)
+        if cached is not None and time.monotonic() - cached[0] < self.PINS_CACHE_TTL:
+            return cached[1]
+        pins = frozenset([m.id async for m in channel.pins(limit=None)])
+        self._pins_cache[channel.id] = (time.monotonic(), pins)
+        return pins
+
+    async def _invalidate_pins(self, channel: discord.abc.GuildChannel, last_pin: Optional[datetime.datetime]) -> None:
+        self._pins_cache.pop(channel.id, None)
+
+    @staticmethod
+    def _describe_deletion(messages: Sequence[discord.PartialMessage]) -> str:
+        if len(messages) == 1:
+            return f"message {messages[0].channel.id}-{messages[0].id}"
+        return f"{len(messages)} messages in channel {messages[0].channel.id} (bulk deletion)"
+
+    async def _attempt_deletion(self, deletion: Awaitable, messages: Sequence[discord.PartialMessage]) -> int:
+        """
+        Awaits a deletion of `messages` (a single message, or a bulk deletion), returning how many failed to delete.
+        Failures that shouldn't interrupt the rest of the clearing operation are logged and suppressed.
+        """
         try:
-            m = await message.fetch()
-            return m.pinned
-        except discord.HTTPException:
-            return False
+            await deletion
+            return 0
+        except discord.Forbidden:
+            # Can't do anything, but permissions could be different in other channels, so continue.
+            self.logger.warning(
+                "Failed to delete %s due to insufficient permissions.", self._describe_deletion(messages)
+            )
+            return len(messages)
+        except discord.NotFound:
+            # Most likely already deleted
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info("Failed to delete %s, not found.", self._describe_deletion(messages))
+            return len(messages)
+        except discord.HTTPException as e:
+            self.logger.warning(
+                "Failed to delete %s due to HTTP error %s: %s", self._describe_deletion(messages), e.status, e.text
+            )
+            # This compromises the validity of this operation.
+            # The messages in the database shouldn't be cleared, so let it interrupt the function.
+            raise
 
     async def clear_expired_messages(self) -> None:
         async with self.delete_lock:
@@ -140,84 +238,90 @@ class AutoDeleteBot(commands.Bot):
                 # If this assumption is true, this will find no more messages on its next check, and pause
                 # until more messages become available. If it is false, then it won't need to check this anyway.
                 self.work_pending.clear()
-                messages = await self.message_registry.pop_expired_messages()
-                messages_by_channel = groupby(messages, lambda m: m.channel)
-
+                message_count = 0
                 skipped_count = 0
                 deletion_reason = "Time-based autodelete"
                 deletions = []
-                for partial_channel, message_group_iter in messages_by_channel:
-                    # Dynamic deletion strategy based on bulk message delete limitations.
-                    partial_channel: discord.PartialMessageable
-                    message_group: Sequence[discord.PartialMessage] = tuple(message_group_iter)
-                    if self.protect_pins:
-                        unfiltered_message_count = len(message_group)
-                        if unfiltered_message_count > 1:
-                            # Retrieve a list of pins to compare against in a single request,
+                # A channel's messages may span several batches, but it only needs to be resolved once.
+                resolved_channels: Dict[int, Optional[discord.abc.Messageable]] = {}
+
+                def dispatch(deletion: Awaitable, targets: Sequence[discord.PartialMessage]) -> None:
+                    # Deletions are started immediately so that they overlap with processing of later batches.
+                    deletions.append(asyncio.ensure_future(self._attempt_deletion(deletion, targets)))
+
+                # Message IDs are snowflakes, so they can be compared against this directly.
+                time_limit = discord.utils.time_snowflake(
+                    discord.utils.utcnow() - datetime.timedelta(days=13.8),  # 14 days, plus margin of error
+                    high=False,
+                )
+                try:
+                    async for message_group in self.message_registry.pop_expired_messages():
+                        # Dynamic deletion strategy based on bulk message delete limitations.
+                        # Each batch holds messages from a single channel.
+                        message_group: Sequence[discord.PartialMessage]
+                        partial_channel: discord.PartialMessageable = message_group[0].channel
+                        message_count += len(message_group)
+                        if self.protect_pins:
+                            # Compare against the channel's (cached) pins in a single request,
                             # rather than fetching each message individually and checking its pinned status.
+                            unfiltered_message_count = len(message_group)
                             try:
-                                channel_pins = {m.id for m in await partial_channel.pins()}
+                                channel_pins = await self._get_pins(partial_channel)
                                 message_group = tuple(m for m in message_group if m.id not in channel_pins)
                             except discord.HTTPException:
                                 pass
-                        elif message_group and self.is_protected_message(message_group[0]):
-                            message_group = ()
-                        if not message_group:
-                            continue
-                        skipped_count += unfiltered_message_count - len(message_group)
-                    time_limit = discord.utils.utcnow() - datetime.timedelta(days=13.8)  # 14 days, plus margin of error
-                    bulk_deletable = tuple(m for m in message_group if m.created_at > time_limit)
-                    non_bulk_deletable = (m for m in message_group if m.created_at <= time_limit)
-
-                    if len(bulk_deletable) == 1:
-                        deletions.append(bulk_deletable[0].delete())
-                    elif bulk_deletable:
-                        # 2+ messages
-                        try:
-                            channel = self.get_channel(partial_channel.id) or await self.fetch_or_deregister_channel(
-                                partial_channel.id
-                            )
-                        except discord.HTTPException:
-                            continue
-                        for start in range(0, len(bulk_deletable), 100):
-                            # Discord limits bulk deletions to 100 messages per API call.
-                            end = start + 100
-                            chunk = bulk_deletable[start:end]
-                            deletions.append(channel.delete_messages(chunk, reason=deletion_reason))
-
-                    for m in non_bulk_deletable:
-                        # Messages older than 14 days cannot be bulk-deleted.
-                        deletions.append(m.delete())
-
-                attempt_count = len(messages) - skipped_count
-                failure_count = 0
-                for message, result in zip(messages, await asyncio.gather(*deletions, return_exceptions=True)):
-                    if isinstance(result, Exception):
-                        failure_count += 1
-                        message_identifier = f"{message.channel.id}-{message.id}"
-                        if isinstance(result, discord.Forbidden):
-                            # Can't do anything, but permissions could be different in other channels, so continue.
-                            self.logger.warning(
-                                f"Failed to delete message {message_identifier} due to insufficient permissions."
-                            )
-                            continue
-                        elif isinstance(result, discord.NotFound):
-                            # Most likely already deleted
-                            self.logger.info(f"Failed to delete message {message_identifier} as it was not found.")
-                            continue
-                        elif isinstance(result, discord.HTTPException):
-                            self.logger.warning(
-                                f"Failed to delete message {message_identifier} due to"
-                                f" HTTP error {result.status}: {result.text}"
-                            )
-                            # This compromises the validity of this operation.
-                            # The messages in the database shouldn't be cleared, so let it interrupt the function.
-                        raise result
+                            skipped_count += unfiltered_message_count - len(message_group)
+                            if not message_group:
+                                continue
+                        bulk_deletable: List[discord.PartialMessage] = []
+                        non_bulk_deletable: List[discord.PartialMessage] = []
+                        for m in message_group:
+                            if m.id > time_limit:
+                                bulk_deletable.append(m)
+                            else:
+                                non_bulk_deletable.append(m)
+
+                        if len(bulk_deletable) == 1:
+                            dispatch(bulk_deletable[0].delete(), bulk_deletable)
+                        elif bulk_deletable:
+                            # 2+ messages
+                            if partial_channel.id not in resolved_channels:
+                                try:
+                                    # This runs inside the registry's pop transaction, so it can't wait for it.
+                                    resolved_channels[partial_channel.id] = await self.resolve_channel(
+                                        partial_channel.id, defer_deregistration=True
+                                    )
+                                except discord.HTTPException:
+                                    resolved_channels[partial_channel.id] = None
+                            channel = resolved_channels[partial_channel.id]
+                            if channel is None:
+                                continue
+                            for start in range(0, len(bulk_deletable), 100):
+                                # Discord limits bulk deletions to 100 messages per API call.
+                                chunk = bulk_deletable[start : start + 100]
+                                dispatch(channel.delete_messages(chunk, reason=deletion_reason), chunk)
+
+                        for m in non_bulk_deletable:
+                            # Messages older than 14 days cannot be bulk-deleted.
+                            dispatch(m.delete(), (m,))
+
+                    failure_count = sum(await asyncio.gather(*deletions))
+                except BaseException:
+                    # Deletions still in flight would otherwise carry on after the transaction is rolled back,
+                    # and any exceptions they raise would never be retrieved.
+                    for deletion in deletions:
+                        deletion.cancel()
+                    await asyncio.gather(*deletions, return_exceptions=True)
+                    raise
+
+                attempt_count = message_count - skipped_count
                 if attempt_count > 0:
-                    self.logger.debug(
-                        f"Cleared {attempt_count - failure_count} messages"
-                        + (f" ({failure_count} failed)." if failure_count else ".")
-                    )
+                    if failure_count:
+                        self.logger.debug(
+                            "Cleared %s messages (%s failed).", attempt_count - failure_count, failure_count
+                        )
+                    else:
+                        self.logger.debug("Cleared %s messages.", attempt_count)
 
     @tasks.loop(reconnect=True)
     async def monitor_expired_messages(self):
@@ -230,33 +334,26 @@ class AutoDeleteBot(commands.Bot):
             self.logger.debug("Finished wait, beginning clearing messages.")
 
     async def _shorten_sleep(self, dt: datetime.datetime) -> None:
-        if dt < self.wake_time:
+        # Bursts of new messages (e.g. while scanning a channel) would otherwise wake the monitor for each message,
+        # for sub-second gains that Discord's rate limits would swallow anyway.
+        if self.wake_time - dt >= self.WAKE_TIME_TOLERANCE:
             self.wake_time = dt
-            if self.active_sleep is not None:
-                self.active_sleep.cancel()
+            self.wake_time_changed.set()
 
     async def _sleep_until(self) -> None:
         """
         Sleeps until self.wake_time.
-        This sleep may be modified by changing self.wake_time and then cancelling self.active_sleep.
+        This sleep may be modified by changing self.wake_time and then setting self.wake_time_changed.
         It is not safe to run this method multiple times concurrently.
         """
         while True:
-            sleeping_until = self.wake_time
-            seconds = (sleeping_until - discord.utils.utcnow()).total_seconds()
-            if seconds > 0:
-                try:
-                    self.active_sleep = asyncio.create_task(asyncio.sleep(seconds))
-                    await self.active_sleep
-                    return
-                except asyncio.CancelledError:
-                    # This could mean that the timer changed.
-                    if sleeping_until == self.wake_time:
-                        # Timer didn't change; unrelated cancellation
-                        raise
-                finally:
-                    self.active_sleep = None
-            else:
+            seconds = (self.wake_time - discord.utils.utcnow()).total_seconds()
+            if seconds <= 0:
+                return
+            self.wake_time_changed.clear()
+            try:
+                await asyncio.wait_for(self.wake_time_changed.wait(), timeout=seconds)
+            except asyncio.TimeoutError:
                 return
 
     async def _wait_until_needed(self) -> None:
@@ -1,7 +1,10 @@
+import asyncio
 import datetime
+import logging
+import sqlite3
 from contextlib import AbstractAsyncContextManager
-from dataclasses import dataclass
-from typing import Dict, Sequence, Tuple, Optional
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Sequence, Tuple, Optional
 
 import aiosqlite
 import discord
@@ -12,6 +15,11 @@ class AutoDeleteChannel:
     id: int
     duration: datetime.timedelta
     after: discord.Object
+    # Amount to add to a message's snowflake ID to get the snowflake of its deletion time.
+    duration_snowflake_delta: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.duration_snowflake_delta = int(self.duration.total_seconds() * 1000) << 22
 
 
 class MessageRegistry(AbstractAsyncContextManager):
@@ -20,23 +28,97 @@ class MessageRegistry(AbstractAsyncContextManager):
     This class must be constructed using its `open` factory method,
     and may be used as a context manager to commit or rollback database edits on exit.
     Note that, like with sqlite3 connections, the context manager form does not open or close the connection itself.
+
+    Newly registered messages are buffered in memory and written to the database in batches by a background task,
+    either once `FLUSH_BATCH_SIZE` messages are pending or `FLUSH_DELAY` seconds after the first one arrives.
+    Since these writes share the connection, they wait while a transaction opened by `pop_expired_messages` is
+    pending, so that committing them doesn't commit the pop before its caller is done with it.
     """
 
+    FLUSH_BATCH_SIZE = 64
+    FLUSH_DELAY = 0.05
+    # Seconds to wait before retrying after the background flush fails.
+    FLUSH_RETRY_DELAY = 1
+
+    # Kept as a single string so that every insert hits the same entry in sqlite3's prepared statement cache.
+    _INSERT_MESSAGES_SQL = r"""
+        INSERT OR IGNORE INTO messages(channel_id, message_id, delete_at) VALUES (?, ?, ?);
+        """
+
     def __init__(self, client: discord.Client, db: aiosqlite.Connection):
         self.client = client
         self.channels: Dict[int, AutoDeleteChannel] = {}
         self.db = db
+        self.logger = logging.getLogger("AutoDelete.MessageRegistry")
+        self._pending_inserts: List[Tuple[int, int, int]] = []
+        self._flush_event = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        # Held from the deletion in pop_expired_messages until its transaction is committed or rolled back.
+        self._pop_lock = asyncio.Lock()
+        self._pop_open = False
+        # Channels deregistered by the caller of pop_expired_messages, to be written once its transaction ends.
+        self._deferred_deregistrations: List[int] = []
 
     @classmethod
     async def open(cls, client: discord.Client, db_path: str) -> "MessageRegistry":
+        # pop_expired_messages relies on DELETE ... RETURNING.
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            raise RuntimeError(
+                f"SQLite 3.35.0 or later is required, but Python is linked against SQLite {sqlite3.sqlite_version}."
+            )
         message_registry = MessageRegistry(client, await aiosqlite.connect(db_path))
         await message_registry._init_db()
         await message_registry._init_channels()
+        message_registry._flusher = asyncio.create_task(message_registry._flush_loop())
         return message_registry
 
     async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
         await self.db.close()
 
+    async def _flush_loop(self) -> None:
+        while True:
+            # Set when the first message is buffered, and again if the buffer fills up before the delay elapses.
+            await self._flush_event.wait()
+            self._flush_event.clear()
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.FLUSH_DELAY)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                # The batch is kept by flush, so this just needs to make sure it's tried again.
+                self.logger.exception("Failed to write registered messages to the database, retrying.")
+                await asyncio.sleep(self.FLUSH_RETRY_DELAY)
+                self._flush_event.set()
+
+    async def flush(self) -> None:
+        """Writes all buffered message registrations to the database."""
+        batch, self._pending_inserts = self._pending_inserts, []
+        if not batch:
+            return
+        try:
+            async with self._pop_lock:
+                # Messages from channels deregistered in the meantime would violate the foreign key constraint.
+                # This must be checked after acquiring the lock, since channels may be deregistered while waiting.
+                rows = [row for row in batch if row[0] in self.channels]
+                if rows:
+                    await self.db.executemany(self._INSERT_MESSAGES_SQL, rows)
+                    await self.db.commit()
+        except BaseException:
+            # Including cancellation by close(), which flushes again afterwards.
+            # Rows buffered in the meantime are newer, so the batch goes back in front of them.
+            self._pending_inserts[:0] = batch
+            raise
+
     async def _init_db(self) -> None:
         await self.db.executescript(r"""
             CREATE TABLE IF NOT EXISTS channels (
@@ -54,8 +136,15 @@ class MessageRegistry(AbstractAsyncContextManager):
                     ON DELETE CASCADE,
                 PRIMARY KEY (channel_id, message_id)
             );
+
+            CREATE INDEX IF NOT EXISTS idx_messages_delete_at ON messages (delete_at);
             
             PRAGMA foreign_keys = ON;
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA cache_size = -20000;
+            PRAGMA mmap_size = 134217728;
            """)
         self.db.row_factory = aiosqlite.Row
 
@@ -68,35 +157,53 @@ class MessageRegistry(AbstractAsyncContextManager):
                 after = discord.Object(c["after"])
                 self.channels[channel_id] = AutoDeleteChannel(id=channel_id, duration=duration, after=after)
 
-    async def pop_expired_messages(self) -> Sequence[discord.PartialMessage]:
+    async def pop_expired_messages(self, batch_size: int = 100) -> AsyncIterator[List[discord.PartialMessage]]:
+        """
+        Removes expired messages from the database, yielding them in batches of up to `batch_size` messages
+        that all belong to the same channel.
+        """
+        await self.flush()
+        await self._pop_lock.acquire()
+        self._pop_open = True
         now = discord.utils.time_snowflake(discord.utils.utcnow(), high=False)
-        # channels.after may have been updated since the deletion was originally scheduled
-        # so it is important to filter the result set here.
-        # Ordering by the channel ID allows for itertools.groupby to be used on the output data.
+        # Snapshot of the registered channels, so the result set is filtered consistently
+        # even if channels are reconfigured while the caller is consuming batches.
+        afters = {channel_id: channel_config.after.id for channel_id, channel_config in self.channels.items()}
+        # This will implicitly open a transaction according to Python's DB API
+        # which must be committed externally, once the *calling function* has used the data it retrieved.
         async with self.db.execute(
             r"""
-            SELECT messages.channel_id, message_id FROM messages
-            INNER JOIN channels ON channels.channel_id = messages.channel_id
-            WHERE ? >= delete_at and message_id > channels.after
-            ORDER BY messages.channel_id;
+            DELETE FROM messages
+            WHERE ? >= delete_at
+            RETURNING channel_id, message_id;
             """,
             (now,),
         ) as cursor:
             cursor: aiosqlite.Cursor
+            # SQLite performs the whole deletion before returning the first row,
+            # so there is nothing to gain from holding the statement open while the caller works.
+            rows = await cursor.fetchall()
 
-            messages = tuple(map(self._row_to_partial_message, await cursor.fetchall()))
-
-            # This will implicitly open a transaction according to Python's DB API
-            # which must be committed externally, once the *calling function* has used the data it retrieved.
-            await cursor.execute(
-                r"""
-                DELETE FROM messages
-                WHERE ? >= delete_at;
-                """,
-                (now,),
-            )
-
-            return messages
+        # channels.after may have been updated since the deletion was originally scheduled,
+        # and the channel may have been deregistered since, so it is important to filter the result set here.
+        # self.channels mirrors the channels table, so this is done in Python rather than with a JOIN.
+        # Messages are grouped by channel ID, and each channel's messages share a single channel object.
+        batches: Dict[int, List[discord.PartialMessage]] = {}
+        partial_channels: Dict[int, discord.PartialMessageable] = {}
+        for row in rows:
+            channel_id = row["channel_id"]
+            after = afters.get(channel_id)
+            if after is None or row["message_id"] <= after:
+                continue
+            partial_channel = partial_channels.get(channel_id)
+            if partial_channel is None:
+                partial_channel = partial_channels[channel_id] = self.client.get_partial_messageable(id=channel_id)
+            batch = batches.setdefault(channel_id, [])
+            batch.append(discord.PartialMessage(channel=partial_channel, id=row["message_id"]))
+            if len(batch) >= batch_size:
+                yield batches.pop(channel_id)
+        for batch in batches.values():
+            yield batch
 
     def _row_to_partial_message(self, row: aiosqlite.Row) -> discord.PartialMessage:
         channel_id = row["channel_id"]
@@ -109,6 +216,7 @@ class MessageRegistry(AbstractAsyncContextManager):
     async def get_next_expiring_message(
         self,
     ) -> Tuple[Optional[discord.PartialMessage], Optional[datetime.datetime]]:
+        await self.flush()
         async with self.db.execute(r"""
                 SELECT channel_id, message_id, delete_at FROM messages
                 ORDER BY delete_at
@@ -122,67 +230,127 @@ class MessageRegistry(AbstractAsyncContextManager):
             else:
                 return None, None
 
-    async def register_message(self, message: discord.Message) -> Optional[datetime.datetime]:
+    def register_message(self, message: discord.Message) -> Optional[datetime.datetime]:
+        """
+        Schedules a message for deletion, returning its deletion time.
+        The message is only buffered here; it is written to the database by the next `flush`.
+        """
         channel_config = self.channels.get(message.channel.id)
         if channel_config is None:
             return None
 
-        delete_at = message.created_at + channel_config.duration
-        await self.db.execute(
-            r"""
-            INSERT INTO messages(channel_id, message_id, delete_at) VALUES (?, ?, ?);
-            """,
-            (message.channel.id, message.id, discord.utils.time_snowflake(delete_at)),
-        )
-        await self.db.commit()
-        return delete_at
+        # Message IDs are snowflakes, so the deletion time can be computed without converting to a datetime.
+        delete_at = message.id + channel_config.duration_snowflake_delta
+        self._pending_inserts.append((message.channel.id, message.id, delete_at))
+        pending_count = len(self._pending_inserts)
+        if pending_count == 1 or pending_count >= self.FLUSH_BATCH_SIZE:
+            self._flush_event.set()
+        return discord.utils.snowflake_time(delete_at)
+
+    async def register_messages_bulk(self, messages: Sequence[discord.Message]) -> Optional[datetime.datetime]:
+        """
+        Schedules several messages for deletion, writing them to the database in a single commit.
+        Returns the earliest of their deletion times, or None if none of them belong to an autodelete channel.
+        """
+        async with self._pop_lock:
+            # Channels may be deregistered while waiting for the lock,
+            # so the rows are only built once it's held, to avoid violating the foreign key constraint.
+            rows = []
+            for message in messages:
+                channel_config = self.channels.get(message.channel.id)
+                if channel_config is not None:
+                    rows.append((message.channel.id, message.id, message.id + channel_config.duration_snowflake_delta))
+            if not rows:
+                return None
+
+            await self.db.executemany(self._INSERT_MESSAGES_SQL, rows)
+            await self.db.commit()
+        return discord.utils.snowflake_time(min(row[2] for row in rows))
 
     async def register_channel(self, channel_config: AutoDeleteChannel):
         assert channel_config.duration.total_seconds() > 0
-        await self.db.execute(r""" DELETE FROM channels WHERE channel_id = ?; """, (channel_config.id,))
-        # "On conflict" clause is relevant to prevent race conditions
-        await self.db.execute(
-            r"""
-            INSERT INTO channels(channel_id, duration_seconds, after) VALUES (?, ?, ?)
-            ON CONFLICT (channel_id) DO UPDATE SET duration_seconds = excluded.duration_seconds, after = excluded.after;
-            """,
-            (channel_config.id, channel_config.duration.total_seconds(), channel_config.after.id),
-        )
-        await self.db.commit()
+        # Buffered messages were scheduled under the old configuration, so they should be cleared with it.
+        await self.flush()
+        async with self._pop_lock:
+            await self.db.execute(r""" DELETE FROM channels WHERE channel_id = ?; """, (channel_config.id,))
+            # "On conflict" clause is relevant to prevent race conditions
+            await self.db.execute(
+                r"""
+                INSERT INTO channels(channel_id, duration_seconds, after) VALUES (?, ?, ?)
+                ON CONFLICT (channel_id) DO UPDATE
+                SET duration_seconds = excluded.duration_seconds, after = excluded.after;
+                """,
+                (channel_config.id, channel_config.duration.total_seconds(), channel_config.after.id),
+            )
+            await self.db.commit()
         # Since self.channels is used for preliminary checks, it should be updated last.
         self.channels[channel_config.id] = channel_config
 
-    async def deregister_channel(self, channel: int) -> bool:
+    async def deregister_channel(self, channel: int, *, defer: bool = False) -> bool:
+        """
+        Disables autodelete for a channel, returning whether it was enabled.
+        The caller of `pop_expired_messages` can't wait for its own transaction to end, so it must set `defer`,
+        in which case the deregistration is written to the database after that transaction is committed or rolled back.
+        """
         try:
             del self.channels[channel]
         except KeyError:
             # Channel was already deregistered
             return False
 
-        await self.db.execute(r""" DELETE FROM channels WHERE channel_id = ?; """, (channel,))
-        await self.db.commit()
+        if defer and self._pop_open:
+            self._deferred_deregistrations.append(channel)
+        else:
+            async with self._pop_lock:
+                await self.db.execute(r""" DELETE FROM channels WHERE channel_id = ?; """, (channel,))
+                await self.db.commit()
         return True
 
+    async def _end_pop(self) -> None:
+        if not self._pop_open:
+            return
+        self._pop_open = False
+        self._pop_lock.release()
+
+        deferred, self._deferred_deregistrations = self._deferred_deregistrations, []
+        # Skip channels that were registered again in the meantime.
+        deferred = [(channel,) for channel in deferred if channel not in self.channels]
+        if deferred:
+            async with self._pop_lock:
+                await self.db.executemany(r""" DELETE FROM channels WHERE channel_id = ?; """, deferred)
+                await self.db.commit()
+
     async def commit(self) -> None:
-        await self.db.commit()
+        try:
+            await self.db.commit()
+        finally:
+            await self._end_pop()
 
     async def rollback(self) -> None:
-        await self.db.rollback()
+        try:
+            await self.db.rollback()
+        finally:
+            await self._end_pop()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
         if exc_type is None:
-            await self.db.commit()
+            await self.commit()
         else:
-            await self.db.rollback()
+            await self.rollback()
 
-    async def get_latest_message(self, channel: int) -> Optional[discord.PartialMessage]:
+    async def get_latest_message(self, channel: int, after: int = 0) -> Optional[discord.PartialMessage]:
+        """
+        Returns the newest registered message in a channel, if it is newer than the message ID `after`.
+        This is a seek on the primary key index, which already leads with the channel ID.
+        """
+        await self.flush()
         async with self.db.execute(
             r"""
-            SELECT channel_id, message_id FROM messages WHERE channel_id = ?
+            SELECT channel_id, message_id FROM messages WHERE channel_id = ? AND message_id > ?
             ORDER BY message_id DESC
             LIMIT 1;
             """,
-            (channel,),
+            (channel, after),
         ) as cursor:
             m = await cursor.fetchone()
             if m is not None:
@@ -1,3 +1,4 @@
+import aiohttp
 import dotenv
 
 import os
@@ -109,8 +110,16 @@ async def async_main():
     except ImportError:
         pass
 
+    # Deletions are sent in bursts to the same host, so keeping connections alive between them
+    # avoids repeating TLS handshakes on every monitor cycle.
+    # The pool is left unlimited, as in discord.py's default connector, so concurrent deletions aren't throttled.
+    connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300, keepalive_timeout=75)
     bot = AutoDeleteBot(
-        sync_commands=args.sync, db_path=args.database, log_path=args.log, protect_pins=args.protect_pins
+        sync_commands=args.sync,
+        db_path=args.database,
+        log_path=args.log,
+        protect_pins=args.protect_pins,
+        connector=connector,
     )
     bot.tree.add_command(AutoDeleteChannelControl())
     async with bot:
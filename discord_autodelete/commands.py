@@ -39,7 +39,7 @@ class AutoDeleteChannelControl(app_commands.Group):
         index = []
         for channel_id, config in bot.message_registry.channels.items():
             try:
-                channel = bot.get_channel(channel_id) or await bot.fetch_or_deregister_channel(channel_id)
+                channel = await bot.resolve_channel(channel_id)
             except discord.HTTPException:
                 continue
             if channel.guild.id == interaction.guild_id: